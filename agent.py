@@ -1,18 +1,38 @@
 import os
 import json
 import math
-from typing import List, Dict
+import heapq
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Iterator
 from dotenv import load_dotenv
 from openai import OpenAI
 
 from tools_schema import TOOLS
 from db import engine, get_db
+from scheduler import scheduler, estimate_tokens, INTERACTIVE, BULK
+from singleflight import SingleFlight
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# retries are handled by the scheduler so they share the rate-limit budget
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 OPENAI_EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+BATCH_ASK_CONCURRENCY = int(os.getenv("BATCH_ASK_CONCURRENCY", "4"))
+# how many ranked chunks to keep per question when retrieval is shared across a batch
+BATCH_PREFETCH_K = 20
+# retrieve for the question before the first LLM call instead of waiting for the model to ask
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "false").lower() in ("1", "true", "yes")
+SPECULATIVE_TOP_K = 3
+
+# concurrent identical query embeddings / document loads share one in-flight call
+embedding_flight = SingleFlight()
+document_flight = SingleFlight()
+# concurrent uploads of the same bytes to the same doc_id ingest once
+ingest_flight = SingleFlight()
 
 SYSTEM_PROMPT = """
 You are a document QA agent. Your job is:
@@ -27,7 +47,12 @@ If you call the `search_document` tool, pass a JSON object with the `query`, an
 """
 
 
-def call_llm(messages, tools=TOOLS, tool_choice="auto"):
+def _raw(endpoint):
+    # prefer the raw-response wrapper so the scheduler can read rate-limit headers
+    return getattr(endpoint, "with_raw_response", endpoint)
+
+
+def call_llm(messages, tools=TOOLS, tool_choice="auto", priority=INTERACTIVE):
     kwargs = {
         "model": OPENAI_MODEL,
         "messages": messages,
@@ -37,12 +62,31 @@ def call_llm(messages, tools=TOOLS, tool_choice="auto"):
         kwargs["tools"] = tools
         kwargs["tool_choice"] = tool_choice
 
-    return client.chat.completions.create(**kwargs)
+    tokens = estimate_tokens([m.get("content") or "" for m in messages if isinstance(m, dict)])
+    return scheduler.run(lambda: _raw(client.chat.completions).create(**kwargs), priority=priority, tokens=tokens)
+
+
+def embed_texts(inputs: List[str], priority=INTERACTIVE) -> List[List[float]]:
+    """Embed a list of texts in a single scheduled request, preserving input order."""
+    resp = scheduler.run(
+        lambda: _raw(client.embeddings).create(model=OPENAI_EMBEDDING_MODEL, input=inputs),
+        priority=priority,
+        tokens=estimate_tokens(inputs),
+    )
+    return [d.embedding for d in resp.data]
+
+
+def embed_query(query: str, priority=INTERACTIVE) -> List[float]:
+    # priority is part of the key so a bulk leader never makes interactive callers wait behind it
+    return embedding_flight.do(
+        (OPENAI_EMBEDDING_MODEL, query, priority),
+        lambda: embed_texts([query], priority=priority)[0],
+    )
 
 
 # --- DB / indexing helpers -------------------------------------------------
 
-from sqlalchemy import text as sa_text
+from sqlalchemy import inspect as sa_inspect, text as sa_text
 
 def create_tables():
     # create a simple table to hold text chunks and embeddings
@@ -60,6 +104,23 @@ def create_tables():
                 """
             )
         )
+        # content hash of each ingested file, so identical uploads can skip extraction
+        conn.execute(
+            sa_text(
+                """
+                CREATE TABLE IF NOT EXISTS documents (
+                    doc_id TEXT NOT NULL,
+                    content_hash TEXT NOT NULL
+                )
+                """
+            )
+        )
+        conn.execute(
+            sa_text("CREATE UNIQUE INDEX IF NOT EXISTS documents_doc_hash ON documents (doc_id, content_hash)")
+        )
+        # chunks this file contributed; tables created before the column existed get it added
+        if "chunk_count" not in [c["name"] for c in sa_inspect(conn).get_columns("documents")]:
+            conn.execute(sa_text("ALTER TABLE documents ADD COLUMN chunk_count INTEGER"))
 
 
 def _chunk_text(text: str, max_chars: int = 1000, overlap: int = 200) -> List[str]:
@@ -114,24 +175,49 @@ def _extract_text_from_file(file_path: str) -> str:
         raise ValueError(f"Unsupported file type: {ext}. Supported: .txt, .pdf, .docx, .doc")
 
 
-def ingest_document_text(doc_id: str, text: str):
-    """Split the document, compute embeddings and store chunks in DB."""
+def _record_document(conn, doc_id: str, content_hash: str, chunk_count: int) -> int:
+    # another worker process may have recorded the same pair first; that is not an error
+    return conn.execute(
+        sa_text(
+            "INSERT INTO documents (doc_id, content_hash, chunk_count) VALUES (:doc_id, :h, :n) "
+            "ON CONFLICT (doc_id, content_hash) DO NOTHING"
+        ),
+        {"doc_id": doc_id, "h": content_hash, "n": chunk_count},
+    ).rowcount
+
+
+def ingest_document_text(doc_id: str, text: str, content_hash: str = None):
+    """Split the document, compute embeddings and store chunks in DB.
+
+    With `content_hash`, the file is recorded in `documents` in the same transaction as
+    its last chunks, together with how many chunks it contributed.
+    """
     try:
         create_tables()
         chunks = _chunk_text(text)
         inserted = 0
 
-        for i, c in enumerate(chunks):
-            # create embedding
-            resp = client.embeddings.create(model=OPENAI_EMBEDDING_MODEL, input=c)
-            emb = resp.data[0].embedding
+        if content_hash and not chunks:
+            with engine.begin() as conn:
+                _record_document(conn, doc_id, content_hash, 0)
+
+        for start in range(0, len(chunks), EMBEDDING_BATCH_SIZE):
+            batch = chunks[start:start + EMBEDDING_BATCH_SIZE]
+            # ingest runs at bulk priority so live questions are served first
+            embs = embed_texts(batch, priority=BULK)
+            rows = [
+                {"doc_id": doc_id, "chunk_id": f"{doc_id}_chunk_{start + j}", "text": c, "embedding": json.dumps(emb)}
+                for j, (c, emb) in enumerate(zip(batch, embs))
+            ]
             # store as JSON
             with engine.begin() as conn:
                 conn.execute(
                     sa_text("INSERT INTO chunks (doc_id, chunk_id, text, embedding) VALUES (:doc_id, :chunk_id, :text, :embedding)"),
-                    {"doc_id": doc_id, "chunk_id": f"{doc_id}_chunk_{i}", "text": c, "embedding": json.dumps(emb)},
+                    rows,
                 )
-            inserted += 1
+                if content_hash and start + len(batch) == len(chunks):
+                    _record_document(conn, doc_id, content_hash, len(chunks))
+            inserted += len(rows)
 
         return {"doc_id": doc_id, "chunks_added": inserted}
     except Exception as e:
@@ -139,9 +225,79 @@ def ingest_document_text(doc_id: str, text: str):
         raise
 
 
-def ingest_document_file(path: str, doc_id: str = None):
+def find_document_by_hash(content_hash: str, doc_id: str = None):
+    """Return a doc_id whose chunks can stand in for a file with `content_hash`.
+
+    `doc_id` itself is returned if it already ingested these bytes. Otherwise only documents
+    whose chunks all came from exactly this one file qualify: the file must be the only one
+    recorded for that doc_id and the doc_id must hold exactly the chunks the file added
+    (chunks ingested without a hash, or still being ingested, change the count).
+    """
+    create_tables()
+    with engine.connect() as conn:
+        if doc_id and conn.execute(
+            sa_text("SELECT 1 FROM documents WHERE doc_id = :doc_id AND content_hash = :h"),
+            {"doc_id": doc_id, "h": content_hash}
+        ).first():
+            return doc_id
+        row = conn.execute(
+            sa_text("SELECT d.doc_id FROM documents d WHERE d.content_hash = :h AND " + _SOLE_CONTENT),
+            {"h": content_hash}
+        ).first()
+    return row[0] if row else None
+
+
+# `d` is a documents row whose doc_id holds exactly that file's chunks and nothing else
+_SOLE_CONTENT = (
+    "(SELECT COUNT(*) FROM documents e WHERE e.doc_id = d.doc_id) = 1 "
+    "AND (SELECT COUNT(*) FROM chunks c WHERE c.doc_id = d.doc_id) = d.chunk_count"
+)
+
+
+def _ingest_hashed_file(path: str, doc_id: str, content_hash: str):
+    existing = find_document_by_hash(content_hash, doc_id)
+    if existing == doc_id:
+        # same bytes already indexed under this id: nothing to do
+        return {"doc_id": doc_id, "chunks_added": 0, "duplicate_of": existing}
+    if existing:
+        # same bytes are the sole content of another id: reuse its chunks and embeddings
+        with engine.connect() as conn:
+            with conn.begin() as trans:
+                count = conn.execute(
+                    sa_text("SELECT d.chunk_count FROM documents d WHERE d.doc_id = :src AND d.content_hash = :h AND " + _SOLE_CONTENT),
+                    {"src": existing, "h": content_hash},
+                ).scalar()
+                if not _record_document(conn, doc_id, content_hash, count or 0):
+                    # another worker process ingested the same bytes under doc_id meanwhile
+                    trans.rollback()
+                    return {"doc_id": doc_id, "chunks_added": 0, "duplicate_of": doc_id}
+                # the count is re-checked in the same statement as the copy
+                result = conn.execute(
+                    sa_text(
+                        "INSERT INTO chunks (doc_id, chunk_id, text, embedding) "
+                        "SELECT :doc_id, :doc_id || substr(chunk_id, length(:src) + 1), text, embedding "
+                        "FROM chunks WHERE doc_id = :src "
+                        "AND (SELECT COUNT(*) FROM chunks c WHERE c.doc_id = :src) = :n"
+                    ),
+                    {"doc_id": doc_id, "src": existing, "n": count},
+                )
+                if count and result.rowcount == count:
+                    return {"doc_id": doc_id, "chunks_added": result.rowcount, "duplicate_of": existing}
+                # the source changed since the lookup: fall back to a normal ingest
+                trans.rollback()
+
+    text = _extract_text_from_file(path)
+    return ingest_document_text(doc_id, text, content_hash)
+
+
+def ingest_document_file(path: str, doc_id: str = None, content_hash: str = None):
     if not doc_id:
         doc_id = os.path.splitext(os.path.basename(path))[0]
+
+    if content_hash:
+        # check-then-ingest must not interleave for the same bytes and doc_id
+        return ingest_flight.do((content_hash, doc_id), lambda: _ingest_hashed_file(path, doc_id, content_hash))
+
     text = _extract_text_from_file(path)
     return ingest_document_text(doc_id, text)
 
@@ -158,44 +314,175 @@ def _cosine_similarity(a: List[float], b: List[float]) -> float:
     return dot / (norm_a * norm_b)
 
 
-def search_document(query: str, doc_id: str = "doc1", top_k: int = 3) -> List[Dict]:
-    """Tool function used by the LLM. Returns `top_k` relevant chunks for `query` in `doc_id`."""
-    # compute query embedding
-    q_resp = client.embeddings.create(model=OPENAI_EMBEDDING_MODEL, input=query)
-    q_emb = q_resp.data[0].embedding
-
-    # fetch all chunks for doc_id
+def _fetch_document_chunks(doc_id: str) -> List[Dict]:
     with engine.connect() as conn:
         rows = conn.execute(
             sa_text("SELECT chunk_id, text, embedding FROM chunks WHERE doc_id = :doc_id"),
             {"doc_id": doc_id}
         ).fetchall()
 
-    candidates = []
+    chunks = []
     for r in rows:
         chunk_id, text, emb_json = r
         try:
             emb = json.loads(emb_json)
         except Exception:
             continue
-        score = _cosine_similarity(q_emb, emb)
-        candidates.append({"chunk_id": chunk_id, "text": text, "score": score})
+        chunks.append({"chunk_id": chunk_id, "text": text, "embedding": emb})
+    return chunks
+
+
+def load_document_chunks(doc_id: str) -> List[Dict]:
+    """Fetch and decode all chunks for `doc_id`. The returned list is shared; do not mutate it."""
+    return document_flight.do(doc_id, lambda: _fetch_document_chunks(doc_id))
+
+
+def search_document(query: str, doc_id: str = "doc1", top_k: int = 3, priority=INTERACTIVE) -> List[Dict]:
+    """Tool function used by the LLM. Returns `top_k` relevant chunks for `query` in `doc_id`."""
+    # compute query embedding
+    q_emb = embed_query(query, priority)
+
+    # fetch all chunks for doc_id
+    chunks = load_document_chunks(doc_id)
+
+    candidates = []
+    for c in chunks:
+        score = _cosine_similarity(q_emb, c["embedding"])
+        candidates.append({"chunk_id": c["chunk_id"], "text": c["text"], "score": score})
 
     candidates.sort(key=lambda x: x["score"], reverse=True)
     return candidates[:max(0, int(top_k))]
 
 
+def search_document_many(queries: List[str], doc_id: str = "doc1", top_k: int = 3, priority=INTERACTIVE) -> List[List[Dict]]:
+    """Like `search_document` for many queries: one embedding request and one pass over the chunks."""
+    if not queries:
+        return []
+    q_embs = embed_texts(queries, priority=priority)
+    chunks = load_document_chunks(doc_id)
+
+    q_norms = [math.sqrt(sum(x * x for x in q)) for q in q_embs]
+    scored = [[] for _ in queries]
+    for c in chunks:
+        emb = c["embedding"]
+        c_norm = math.sqrt(sum(y * y for y in emb))
+        for i, q in enumerate(q_embs):
+            if q_norms[i] == 0 or c_norm == 0:
+                score = 0.0
+            else:
+                score = sum(x * y for x, y in zip(q, emb)) / (q_norms[i] * c_norm)
+            scored[i].append({"chunk_id": c["chunk_id"], "text": c["text"], "score": score})
+
+    k = max(0, int(top_k))
+    # nlargest is stable, so ties keep chunk order just like search_document's sort
+    return [heapq.nlargest(k, cands, key=lambda x: x["score"]) for cands in scored]
+
+
 # --- agent executor (supports tool-calls) --------------------------------
 
-def agent_executor(user_question: str, doc_id: str = "doc1") -> Dict:
+_executor_lock = threading.Lock()
+_executor_stats = {
+    mode: {"runs": 0, "llm_rounds": 0, "rounds_saved": 0, "total_latency": 0.0, "max_latency": 0.0}
+    for mode in ("standard", "speculative")
+}
+
+
+def _record_run(mode: str, run: Dict, latency: float):
+    with _executor_lock:
+        st = _executor_stats[mode]
+        st["runs"] += 1
+        st["llm_rounds"] += run["rounds"]
+        # speculation saved a round only if the run answered and the model's first response
+        # used the prefetched context: a direct answer, or a search for something else
+        if mode == "speculative" and run["answered"] and run["first_response"] in ("answer", "other_search"):
+            st["rounds_saved"] += 1
+        st["total_latency"] += latency
+        st["max_latency"] = max(st["max_latency"], latency)
+
+
+def executor_stats() -> Dict:
+    with _executor_lock:
+        out = {}
+        for mode, st in _executor_stats.items():
+            runs = st["runs"]
+            out[mode] = {
+                "runs": runs,
+                "llm_rounds": st["llm_rounds"],
+                "avg_rounds": st["llm_rounds"] / runs if runs else 0.0,
+                "rounds_saved": st["rounds_saved"],
+                "avg_latency_ms": 1000 * st["total_latency"] / runs if runs else 0.0,
+                "max_latency_ms": 1000 * st["max_latency"],
+            }
+    spec, std = out["speculative"], out["standard"]
+    spec["rounds_saved_basis"] = ("answered speculative runs whose first LLM response was a direct answer "
+                                  "or a search different from the prefetched one")
+    spec["standard_avg_rounds"] = std["avg_rounds"]
+    # measured difference, only meaningful when both modes have served comparable questions
+    spec["avg_rounds_delta_vs_standard"] = (
+        std["avg_rounds"] - spec["avg_rounds"] if std["runs"] and spec["runs"] else None
+    )
+    return out
+
+
+def _prefetch_messages(user_question: str, doc_id: str, retrieved: Dict = None, priority=INTERACTIVE) -> List[Dict]:
+    """Search for the question up front and present it as an already answered tool call."""
+    if retrieved and (user_question, doc_id) in retrieved:
+        result = retrieved[(user_question, doc_id)][:SPECULATIVE_TOP_K]
+    else:
+        result = search_document(user_question, doc_id, SPECULATIVE_TOP_K, priority)
+    args = {"query": user_question, "doc_id": doc_id, "top_k": SPECULATIVE_TOP_K}
+    return [
+        {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [{
+                "id": "call_prefetch",
+                "type": "function",
+                "function": {"name": "search_document", "arguments": json.dumps(args)},
+            }],
+        },
+        {
+            "role": "tool",
+            "tool_call_id": "call_prefetch",
+            "name": "search_document",
+            "content": json.dumps(result),
+        },
+    ]
+
+
+def agent_executor(user_question: str, doc_id: str = "doc1", retrieved: Dict = None, priority=INTERACTIVE,
+                   speculative: bool = None) -> Dict:
+    """Run the tool-calling loop for one question.
+
+    `retrieved` maps (query, doc_id) to already ranked chunks (at least BATCH_PREFETCH_K of
+    them, or all of the document); matching search_document calls are served from it.
+    With `speculative` (default: SPECULATIVE_RETRIEVAL) the question is searched before the
+    first LLM call, which usually saves the model's first tool-call round.
+    """
+    if speculative is None:
+        speculative = SPECULATIVE_RETRIEVAL
+
+    start = time.perf_counter()
+    # first_response: "answer", "prefetched_search", "other_search" or "other_tool"
+    run = {"rounds": 0, "first_response": None, "answered": False}
     messages = [
         {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "user", "content": user_question}
     ]
+    try:
+        if speculative:
+            messages.extend(_prefetch_messages(user_question, doc_id, retrieved, priority))
+        return _agent_loop(messages, user_question, doc_id, retrieved, priority, run, speculative)
+    finally:
+        _record_run("speculative" if speculative else "standard", run, time.perf_counter() - start)
+
 
+def _agent_loop(messages: List[Dict], user_question: str, doc_id: str, retrieved: Dict, priority,
+                run: Dict, speculative: bool) -> Dict:
     max_rounds = 4
     for _round in range(max_rounds):
-        resp = call_llm(messages)
+        run["rounds"] += 1
+        resp = call_llm(messages, priority=priority)
         choice = resp.choices[0]
         msg = choice.message
 
@@ -265,7 +552,13 @@ def agent_executor(user_question: str, doc_id: str = "doc1") -> Dict:
                 q = tool_args.get("query") if tool_args else user_question
                 top_k = int(tool_args.get("top_k", 3)) if tool_args else 3
                 d_id = tool_args.get("doc_id", doc_id) if tool_args else doc_id
-                result = search_document(q, d_id, top_k)
+                if run["rounds"] == 1:
+                    same = speculative and (q, d_id) == (user_question, doc_id)
+                    run["first_response"] = "prefetched_search" if same else "other_search"
+                if retrieved and (q, d_id) in retrieved and top_k <= BATCH_PREFETCH_K:
+                    result = retrieved[(q, d_id)][:max(0, top_k)]
+                else:
+                    result = search_document(q, d_id, top_k, priority)
                 # attach the tool output as a tool message for the model
                 # Get tool_call_id from the first tool call
                 tool_call_id = "call_1"
@@ -286,6 +579,8 @@ def agent_executor(user_question: str, doc_id: str = "doc1") -> Dict:
                 continue  # ask the model again with the tool output in context
             else:
                 # unknown tool - send a message back
+                if run["rounds"] == 1:
+                    run["first_response"] = "other_tool"
                 # Get tool_call_id from the first tool call
                 tool_call_id = "call_1"
                 if tool_calls and len(tool_calls) > 0:
@@ -319,6 +614,10 @@ def agent_executor(user_question: str, doc_id: str = "doc1") -> Dict:
             }
             messages.append(final_msg)
 
+            if run["rounds"] == 1:
+                run["first_response"] = "answer"
+            run["answered"] = True
+
             # return the assistant message
             print("[agent] Final answer from model:")
             print(assistant_content)
@@ -328,6 +627,44 @@ def agent_executor(user_question: str, doc_id: str = "doc1") -> Dict:
     return {"error": "No final answer after max rounds"}
 
 
+def retrieve_batch(questions: List[str], doc_id: str = "doc1") -> Dict:
+    """Rank the document's chunks for every distinct question (one embedding request)."""
+    unique = list(dict.fromkeys(questions))
+    ranked = search_document_many(unique, doc_id, top_k=BATCH_PREFETCH_K, priority=BULK)
+    return {(q, doc_id): r for q, r in zip(unique, ranked)}
+
+
+def agent_executor_batch(questions: List[str], doc_id: str = "doc1", max_concurrency: int = BATCH_ASK_CONCURRENCY,
+                         speculative: bool = None, retrieved: Dict = None) -> Iterator[Dict]:
+    """Answer many questions about one document, yielding results as they complete.
+
+    All questions are embedded in a single request and scored against the document in one
+    pass (pass `retrieved` from `retrieve_batch` to do that up front); the per-question LLM
+    loops then run concurrently at bulk priority. Closing the generator early cancels the
+    questions that have not started yet.
+    """
+    if retrieved is None:
+        retrieved = retrieve_batch(questions, doc_id)
+
+    pool = ThreadPoolExecutor(max_workers=max(1, int(max_concurrency)))
+    try:
+        futures = {
+            pool.submit(agent_executor, q, doc_id, retrieved, BULK, speculative): i
+            for i, q in enumerate(questions)
+        }
+        for fut in as_completed(futures):
+            i = futures[fut]
+            try:
+                out = fut.result()
+            except Exception as e:
+                print(f"[agent] Batch question {i} failed: {e}")
+                out = {"error": str(e)}
+            yield {"index": i, "question": questions[i], **out}
+    finally:
+        # on early close (e.g. client disconnected) don't spend quota on queued questions
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
 # --- simple CLI for manual testing ---------------------------------------
 if __name__ == "__main__":
     print("Simple RAG agent CLI. Commands:\n  ingest <file_path> [doc_id]\n  ask <doc_id> <question>\n  exit")
@@ -1,12 +1,30 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, Request, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 from pydantic import BaseModel
 import uvicorn
+import asyncio
+import hashlib
+import tempfile
+import json
 import os
 import agent
 
+# upload limits
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+MAX_CONCURRENT_UPLOADS = int(os.getenv("MAX_CONCURRENT_UPLOADS", "4"))
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR") or None  # None -> system temp dir
+# allowance for multipart boundaries, part headers and the doc_id field
+MULTIPART_OVERHEAD = 64 * 1024
+
+upload_slots = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+
+# the embeddings API accepts at most 2048 inputs per request
+MAX_BATCH_QUESTIONS = int(os.getenv("MAX_BATCH_QUESTIONS", "500"))
+
 app = FastAPI(title="RAG Document QA API")
 
 app.add_middleware(
@@ -17,6 +35,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    # FastAPI parses (and spools) the whole multipart body before the endpoint runs,
+    # so oversized uploads have to be refused here, from Content-Length alone
+    if request.url.path == "/upload":
+        length = request.headers.get("content-length")
+        if length and length.isdigit() and int(length) > MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD:
+            return JSONResponse(status_code=413, content={"detail": f"File too large. Limit is {MAX_UPLOAD_BYTES} bytes"})
+    return await call_next(request)
+
+
 # 提供静态文件服务
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -29,6 +59,14 @@ async def root():
 class AskRequest(BaseModel):
     doc_id: str
     question: str
+    speculative: bool | None = None  # None -> SPECULATIVE_RETRIEVAL
+
+
+class BatchAskRequest(BaseModel):
+    doc_id: str
+    questions: list[str]
+    max_concurrency: int | None = None
+    speculative: bool | None = None
 
 
 @app.get("/health")
@@ -36,6 +74,19 @@ async def health():
     return {"status": "ok"}
 
 
+@app.get("/stats")
+async def stats():
+    """Runtime counters for the agent, the OpenAI request scheduler and request coalescing."""
+    return {
+        "agent": agent.executor_stats(),
+        "scheduler": agent.scheduler.stats(),
+        "coalescing": {
+            "embeddings": agent.embedding_flight.stats(),
+            "documents": agent.document_flight.stats(),
+        },
+    }
+
+
 @app.post("/upload")
 async def upload(file: UploadFile = File(...), doc_id: str | None = Form(None)):
     """Upload a plain text, PDF, or Word file and ingest it into the vector store."""
@@ -50,37 +101,86 @@ async def upload(file: UploadFile = File(...), doc_id: str | None = Form(None)):
     if file.content_type not in supported_types:
         raise HTTPException(status_code=400, detail=f"Unsupported content type: {file.content_type}. Supported: {', '.join(supported_types.keys())}")
 
-    # Save uploaded file temporarily
-    temp_path = f"temp_{file.filename}"
-    try:
-        with open(temp_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
-
-        if not doc_id:
-            # fall back to filename without extension
-            doc_id = (file.filename or "uploaded").rsplit(".", 1)[0]
-
-        res = agent.ingest_document_file(temp_path, doc_id)
-        return {"ingested": res}
-    except Exception as e:
-        print(f"Upload error: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to process file: {str(e)}")
-    finally:
-        # Clean up temp file
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+    # reject early when the size is already known from the multipart part
+    if getattr(file, "size", None) and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"File too large. Limit is {MAX_UPLOAD_BYTES} bytes")
+
+    ext = os.path.splitext(file.filename or "")[1].lower() or supported_types[file.content_type] or ""
+
+    async with upload_slots:
+        temp_path = None
+        try:
+            # Copy the upload to a unique temp file in chunks, hashing as we go
+            fd, temp_path = tempfile.mkstemp(prefix="upload_", suffix=ext, dir=UPLOAD_TMP_DIR)
+            digest = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > MAX_UPLOAD_BYTES:
+                        raise HTTPException(status_code=413, detail=f"File too large. Limit is {MAX_UPLOAD_BYTES} bytes")
+                    digest.update(chunk)
+                    f.write(chunk)
+
+            if not doc_id:
+                # fall back to filename without extension
+                doc_id = (file.filename or "uploaded").rsplit(".", 1)[0]
+
+            res = await run_in_threadpool(agent.ingest_document_file, temp_path, doc_id, digest.hexdigest())
+            return {"ingested": res}
+        except HTTPException:
+            raise
+        except Exception as e:
+            print(f"Upload error: {e}")
+            raise HTTPException(status_code=500, detail=f"Failed to process file: {str(e)}")
+        finally:
+            # Clean up temp file
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
 
 
 @app.post("/ask")
 async def ask(req: AskRequest):
     """Ask a question grounded in a specific document (doc_id)."""
-    out = agent.agent_executor(req.question, req.doc_id)
+    # the agent blocks on the scheduler (rate limits, backoff), so keep it off the event loop
+    out = await run_in_threadpool(agent.agent_executor, req.question, req.doc_id, speculative=req.speculative)
     # normalize output for API consumers
     if "answer" in out:
         return {"answer": out["answer"], "raw": out}
     return {"error": out}
 
 
+@app.post("/ask/batch")
+async def ask_batch(req: BatchAskRequest):
+    """Ask many questions about one document. Streams one JSON object per line as answers complete."""
+    if not req.questions:
+        raise HTTPException(status_code=400, detail="questions must not be empty")
+    if len(req.questions) > MAX_BATCH_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"Too many questions. Limit is {MAX_BATCH_QUESTIONS}")
+
+    concurrency = min(req.max_concurrency or agent.BATCH_ASK_CONCURRENCY, agent.BATCH_ASK_CONCURRENCY)
+
+    # shared retrieval runs before any bytes are sent, so its failures get a proper status
+    try:
+        retrieved = await run_in_threadpool(agent.retrieve_batch, req.questions, req.doc_id)
+    except Exception as e:
+        print(f"Batch retrieval error: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to retrieve context: {str(e)}")
+
+    async def lines():
+        results = agent.agent_executor_batch(req.questions, req.doc_id, concurrency, req.speculative, retrieved)
+        try:
+            async for out in iterate_in_threadpool(results):
+                yield json.dumps(out, ensure_ascii=False) + "\n"
+        finally:
+            # runs when the client disconnects too; cancels questions not yet started
+            results.close()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
 if __name__ == "__main__":
     uvicorn.run("api:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
@@ -0,0 +1,270 @@
+# scheduler.py
+import os
+import re
+import time
+import heapq
+import random
+import itertools
+import threading
+from typing import Callable, Dict, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# lower value = served first
+INTERACTIVE = 0
+BULK = 1
+
+OPENAI_MAX_RPM = int(os.getenv("OPENAI_MAX_RPM", "500"))
+OPENAI_MAX_TPM = int(os.getenv("OPENAI_MAX_TPM", "200000"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "6"))
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at `rate` tokens per second."""
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = float(capacity)
+        self.rate = float(rate)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float = 1.0):
+        # a single request larger than the bucket would never fit, so clamp it
+        amount = min(float(amount), self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(min(wait, 1.0))
+
+    def drain_to(self, remaining: float):
+        # the server knows better than we do: never hold more than it reports
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, float(remaining))
+
+
+def _parse_duration(value: Optional[str]) -> Optional[float]:
+    """Parse rate-limit reset values such as "1s", "6m0s", "20ms" or "0.5" into seconds."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0.0
+    matched = False
+    for num, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        matched = True
+        total += float(num) * {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}[unit]
+    return total if matched else None
+
+
+def _error_status(exc: Exception) -> Optional[int]:
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status
+
+
+def _is_retryable(exc: Exception) -> bool:
+    if _error_status(exc) in RETRYABLE_STATUS:
+        return True
+    # openai.APIConnectionError / APITimeoutError carry no status code
+    return type(exc).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+class RequestScheduler:
+    """Meters OpenAI calls through request/token buckets and a priority-ordered concurrency gate.
+
+    Interactive work (query embeddings, chat) is admitted ahead of bulk ingest batches.
+    The concurrency limit backs off on 429s and grows again while the rate-limit headers
+    report headroom.
+    """
+
+    def __init__(self, rpm: int = OPENAI_MAX_RPM, tpm: int = OPENAI_MAX_TPM,
+                 max_concurrency: int = OPENAI_MAX_CONCURRENCY, max_retries: int = OPENAI_MAX_RETRIES,
+                 base_delay: float = 0.5, max_delay: float = 30.0):
+        self.requests = TokenBucket(rpm, rpm / 60.0)
+        self.tokens = TokenBucket(tpm, tpm / 60.0)
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.limit = self.max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.cond = threading.Condition()
+        self.active = 0
+        self.waiting = []  # heap of (priority, seq)
+        self.seq = itertools.count()
+        # set while the head of the queue is waiting on the buckets
+        self.admitting = False
+        # no new work is admitted before this monotonic time (set from retry-after)
+        self.paused_until = 0.0
+
+        self.counters = {"requests": 0, "retries": 0, "rate_limited": 0, "failures": 0,
+                         "interactive": 0, "bulk": 0}
+
+    # --- admission ---------------------------------------------------------
+
+    def _enter(self, priority: int, tokens: int):
+        """Admit one call in priority order.
+
+        Only the head of the queue draws from the request/token buckets, so queued
+        interactive work is never overtaken by bulk work waiting on the rate limit.
+        """
+        with self.cond:
+            ticket = (priority, next(self.seq))
+            heapq.heappush(self.waiting, ticket)
+            while (self.waiting[0] != ticket or self.admitting or self.active >= self.limit
+                   or time.monotonic() < self.paused_until):
+                self.cond.wait(timeout=0.05)
+            heapq.heappop(self.waiting)
+            self.admitting = True
+            self.active += 1
+        try:
+            self.requests.acquire(1)
+            self.tokens.acquire(tokens)
+        except BaseException:
+            self._leave()
+            raise
+        finally:
+            with self.cond:
+                self.admitting = False
+                # the next waiter may also fit under the limit
+                self.cond.notify_all()
+
+    def _leave(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    # --- feedback from the server -----------------------------------------
+
+    def observe_headers(self, headers):
+        if not headers:
+            return
+
+        def number(name):
+            value = headers.get(name)
+            return float(value) if value is not None else None
+
+        try:
+            remaining_req = number("x-ratelimit-remaining-requests")
+            remaining_tok = number("x-ratelimit-remaining-tokens")
+            limit_req = number("x-ratelimit-limit-requests")
+        except ValueError:
+            # malformed headers must not cost us a successful response
+            return
+
+        if remaining_req is not None:
+            self.requests.drain_to(remaining_req)
+        if remaining_tok is not None:
+            self.tokens.drain_to(remaining_tok)
+
+        with self.cond:
+            if remaining_req is not None and limit_req:
+                headroom = remaining_req / max(1.0, limit_req)
+                if headroom < 0.1:
+                    self.limit = max(1, self.limit - 1)
+                elif self.limit < self.max_concurrency:
+                    self.limit += 1
+            elif self.limit < self.max_concurrency:
+                self.limit += 1
+            self.cond.notify_all()
+
+    def _on_rate_limited(self, headers) -> Optional[float]:
+        with self.cond:
+            self.counters["rate_limited"] += 1
+            self.limit = max(1, self.limit // 2)
+        if not headers:
+            return None
+        delay = _parse_duration(headers.get("retry-after-ms"))
+        if delay is not None:
+            delay /= 1000.0
+        else:
+            delay = _parse_duration(headers.get("retry-after")) or _parse_duration(
+                headers.get("x-ratelimit-reset-requests"))
+        if delay:
+            with self.cond:
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        return delay
+
+    def _backoff(self, attempt: int, hint: Optional[float]) -> float:
+        # full jitter on exponential backoff, never shorter than the server's hint
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if hint:
+            delay = max(delay, hint)
+        return delay
+
+    # --- public API --------------------------------------------------------
+
+    def run(self, fn: Callable, priority: int = INTERACTIVE, tokens: int = 1):
+        """Call `fn()` under the scheduler and return its result.
+
+        If `fn` returns a raw response (anything with `.headers` and `.parse()`, e.g. from
+        `client.embeddings.with_raw_response`), the headers feed the rate limiter and the
+        parsed object is returned instead.
+        """
+        with self.cond:
+            self.counters["interactive" if priority == INTERACTIVE else "bulk"] += 1
+
+        attempt = 0
+        while True:
+            self._enter(priority, tokens)
+            try:
+                with self.cond:
+                    self.counters["requests"] += 1
+                result = fn()
+            except Exception as e:
+                if not _is_retryable(e) or attempt >= self.max_retries:
+                    with self.cond:
+                        self.counters["failures"] += 1
+                    raise
+                headers = getattr(getattr(e, "response", None), "headers", None)
+                hint = self._on_rate_limited(headers) if _error_status(e) == 429 else None
+                delay = self._backoff(attempt, hint)
+                attempt += 1
+                with self.cond:
+                    self.counters["retries"] += 1
+                print(f"[scheduler] retry {attempt}/{self.max_retries} in {delay:.2f}s after: {e}")
+            else:
+                if hasattr(result, "headers") and hasattr(result, "parse"):
+                    self.observe_headers(result.headers)
+                    result = result.parse()
+                return result
+            finally:
+                self._leave()
+            time.sleep(delay)
+
+    def stats(self) -> Dict:
+        with self.cond:
+            out = dict(self.counters)
+            out.update({"concurrency_limit": self.limit, "active": self.active,
+                        "queued": len(self.waiting)})
+        return out
+
+
+scheduler = RequestScheduler()
+
+
+def estimate_tokens(inputs) -> int:
+    # rough heuristic (~4 chars per token), good enough for metering
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    return sum(len(s) // 4 + 1 for s in inputs)
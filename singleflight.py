@@ -0,0 +1,61 @@
+# singleflight.py
+import threading
+from typing import Callable, Dict, Hashable
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one execution.
+
+    The first caller for a key runs `fn`; callers arriving while it is in flight wait
+    and receive the same result (or exception). Nothing is cached once the call finishes,
+    so the shared result must be treated as read-only.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: Dict[Hashable, _Call] = {}
+        self.counters = {"calls": 0, "executed": 0, "coalesced": 0, "errors": 0}
+
+    def do(self, key: Hashable, fn: Callable):
+        with self.lock:
+            self.counters["calls"] += 1
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+                self.counters["executed"] += 1
+            else:
+                self.counters["coalesced"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            with self.lock:
+                self.counters["errors"] += 1
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self) -> Dict:
+        with self.lock:
+            out = dict(self.counters)
+            out["in_flight"] = len(self.calls)
+        return out
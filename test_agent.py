@@ -14,8 +14,8 @@ class MockEmb:
         self.embedding = emb
 
 class MockEmbResp:
-    def __init__(self, emb):
-        self.data = [MockEmb(emb)]
+    def __init__(self, embs):
+        self.data = [MockEmb(e) for e in embs]
 
 class MockChoice:
     def __init__(self, message):
@@ -33,9 +33,8 @@ class MockClient:
         @staticmethod
         def create(model, input):
             # deterministic small vector based on input length
-            val = float(len(input) % 10)
-            emb = [val for _ in range(8)]
-            return MockEmbResp(emb)
+            inputs = [input] if isinstance(input, str) else input
+            return MockEmbResp([[float(len(s) % 10)] * 8 for s in inputs])
 
     class chat:
         class completions:
@@ -90,3 +89,90 @@ print("Running agent_executor for a natural question...")
 out = agent.agent_executor("What is RAG and how is it used?", doc_id="sample")
 print("Agent output:")
 print(json.dumps(out, indent=2, ensure_ascii=False))
+
+print("Running agent_executor_batch for several questions...")
+questions = ["What is RAG?", "How are chunks searched?", "What is RAG?"]
+assert agent.search_document_many(questions[:2], doc_id="sample", top_k=2) == [
+    agent.search_document(q, doc_id="sample", top_k=2) for q in questions[:2]]
+single_calls = agent.embedding_flight.stats()["calls"]
+batch = sorted(agent.agent_executor_batch(questions, doc_id="sample", max_concurrency=2), key=lambda r: r["index"])
+print(json.dumps(batch, indent=2, ensure_ascii=False))
+assert [r["question"] for r in batch] == questions
+assert all("answer" in r for r in batch)
+# retrieval was shared: no per-question query embeddings
+assert agent.embedding_flight.stats()["calls"] == single_calls
+
+print("A batch question that searches beyond the shared retrieval stays at bulk priority...")
+class ResearchingCompletions:
+    @staticmethod
+    def create(**kwargs):
+        messages = kwargs["messages"]
+        if not any(m.get("role") == "tool" for m in messages):
+            # a rephrased query is not in the batch's shared retrieval
+            return MockResp({"tool_calls": [{"id": "call_3", "type": "function", "function": {
+                "name": "search_document",
+                "arguments": json.dumps({"query": "rephrased: " + messages[-1]["content"], "doc_id": "sample", "top_k": 2})}}]})
+        return MockResp({"content": "Answer after a rephrased search"})
+_completions = MockClient.chat.completions
+MockClient.chat.completions = ResearchingCompletions
+before = agent.scheduler.stats()
+batch = list(agent.agent_executor_batch(["What is RAG?"], doc_id="sample"))
+MockClient.chat.completions = _completions
+after = agent.scheduler.stats()
+print("Batch output:", batch, "scheduler:", after)
+assert "answer" in batch[0]
+# shared retrieval embedding + rephrased query embedding + two chat rounds, all bulk
+assert after["bulk"] - before["bulk"] == 4
+assert after["interactive"] == before["interactive"]
+
+print("Closing a batch early cancels questions that have not started...")
+import time
+_agent_executor = agent.agent_executor
+started = []
+def slow_agent_executor(q, *args, **kwargs):
+    started.append(q)
+    time.sleep(0.1)
+    return _agent_executor(q, *args, **kwargs)
+agent.agent_executor = slow_agent_executor
+many = [f"Question {i}?" for i in range(10)]
+results = agent.agent_executor_batch(many, doc_id="sample", max_concurrency=1)
+next(results)
+results.close()
+time.sleep(0.3)
+agent.agent_executor = _agent_executor
+print("Started before close:", len(started))
+assert len(started) <= 2
+
+print("Running agent_executor with speculative pre-retrieval...")
+before = agent.executor_stats()
+out = agent.agent_executor("What is RAG and how is it used?", doc_id="sample", speculative=True)
+print("Agent output:", json.dumps(out, ensure_ascii=False))
+stats = agent.executor_stats()
+print("Executor stats:", json.dumps(stats, indent=2))
+assert "answer" in out
+# the prefetched search answers the first tool call: one LLM round instead of two
+assert stats["speculative"]["llm_rounds"] - before["speculative"]["llm_rounds"] == 1
+assert stats["speculative"]["rounds_saved"] - before["speculative"]["rounds_saved"] == 1
+assert stats["standard"]["avg_rounds"] == 2
+
+print("A speculative run that repeats the prefetched search saves nothing...")
+before = agent.executor_stats()["speculative"]
+class RepeatingCompletions:
+    @staticmethod
+    def create(**kwargs):
+        messages = kwargs["messages"]
+        if messages[-1]["role"] == "user" or sum(m.get("role") == "tool" for m in messages) < 2:
+            question = next(m["content"] for m in messages if m.get("role") == "user")
+            return MockResp({"tool_calls": [{"id": "call_2", "type": "function", "function": {
+                "name": "search_document",
+                "arguments": json.dumps({"query": question, "doc_id": "sample", "top_k": 3})}}]})
+        return MockResp({"content": "Answer after repeating the search"})
+_completions = MockClient.chat.completions
+MockClient.chat.completions = RepeatingCompletions
+out = agent.agent_executor("What is RAG?", doc_id="sample", speculative=True)
+MockClient.chat.completions = _completions
+after = agent.executor_stats()["speculative"]
+print("Agent output:", out, "stats:", after)
+assert "answer" in out
+assert after["llm_rounds"] - before["llm_rounds"] == 2
+assert after["rounds_saved"] == before["rounds_saved"]
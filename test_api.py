@@ -15,8 +15,8 @@ class MockEmb:
         self.embedding = emb
 
 class MockEmbResp:
-    def __init__(self, emb):
-        self.data = [MockEmb(emb)]
+    def __init__(self, embs):
+        self.data = [MockEmb(e) for e in embs]
 
 class MockChoice:
     def __init__(self, message):
@@ -30,9 +30,8 @@ class MockClient:
     class embeddings:
         @staticmethod
         def create(model, input):
-            val = float(len(input) % 10)
-            emb = [val for _ in range(8)]
-            return MockEmbResp(emb)
+            inputs = [input] if isinstance(input, str) else input
+            return MockEmbResp([[float(len(s) % 10)] * 8 for s in inputs])
 
     class chat:
         class completions:
@@ -41,11 +40,15 @@ class MockClient:
                 messages = kwargs.get("messages", [])
                 has_tool_output = any(m.get("role") == "tool" for m in messages)
                 if not has_tool_output:
-                    function_call = {
-                        "name": "search_document",
-                        "arguments": json.dumps({"query": messages[-1]["content"], "doc_id": "sample", "top_k": 2})
-                    }
-                    return MockResp({"function_call": function_call})
+                    tool_calls = [{
+                        "id": "call_1",
+                        "type": "function",
+                        "function": {
+                            "name": "search_document",
+                            "arguments": json.dumps({"query": messages[-1]["content"], "doc_id": "apidoc", "top_k": 2})
+                        }
+                    }]
+                    return MockResp({"tool_calls": tool_calls})
                 else:
                     tool_msg = next((m for m in messages if m.get("role") == "tool"), None)
                     content = tool_msg.get("content")
@@ -69,6 +72,99 @@ files = {"file": ("sample.txt", sample_text, "text/plain")}
 res = client.post("/upload", files=files, data={"doc_id": "apidoc"})
 print("Upload status", res.status_code, res.json())
 
+# Re-uploading identical bytes short-circuits before extraction
+res = client.post("/upload", files=files, data={"doc_id": "apidoc"})
+print("Duplicate upload status", res.status_code, res.json())
+assert res.json()["ingested"]["chunks_added"] == 0
+
+# Identical bytes under a new doc_id reuse the stored chunks
+res = client.post("/upload", files=files, data={"doc_id": "apidoc_copy"})
+print("Copy upload status", res.status_code, res.json())
+assert res.json()["ingested"]["duplicate_of"] == "apidoc"
+
+# Uploads over the size limit are rejected
+import api
+api.MAX_UPLOAD_BYTES = 16
+res = client.post("/upload", files={"file": ("big.txt", "x" * 64, "text/plain")})
+print("Oversized upload status", res.status_code)
+assert res.status_code == 413
+api.MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+
+# ...and refused from Content-Length before the multipart body is parsed
+res = client.post("/upload", files={"file": ("big.txt", "x" * (api.MULTIPART_OVERHEAD + 64), "text/plain")},
+                  headers={"content-length": str(api.MAX_UPLOAD_BYTES + api.MULTIPART_OVERHEAD + 1)})
+print("Oversized Content-Length status", res.status_code)
+assert res.status_code == 413
+
+# A file that is not the sole content of its doc_id is never copied from
+text_a = "File A about retrieval."
+text_b = "File B about something else entirely."
+client.post("/upload", files={"file": ("a.txt", text_a, "text/plain")}, data={"doc_id": "mixed"})
+client.post("/upload", files={"file": ("b.txt", text_b, "text/plain")}, data={"doc_id": "mixed"})
+res = client.post("/upload", files={"file": ("a.txt", text_a, "text/plain")}, data={"doc_id": "clean"})
+print("Upload from mixed doc status", res.status_code, res.json())
+assert "duplicate_of" not in res.json()["ingested"]
+assert [c["text"] for c in agent.load_document_chunks("clean")] == [text_a]
+
+# Chunks ingested without a hash make a doc_id ineligible as a copy source
+text_x = "Text X about cats."
+client.post("/upload", files={"file": ("x.txt", text_x, "text/plain")}, data={"doc_id": "M"})
+agent.ingest_document_text("M", "Secret unrelated text Z.")
+res = client.post("/upload", files={"file": ("x.txt", text_x, "text/plain")}, data={"doc_id": "N"})
+print("Upload after hashless ingest status", res.status_code, res.json())
+assert "duplicate_of" not in res.json()["ingested"]
+assert [c["text"] for c in agent.load_document_chunks("N")] == [text_x]
+
+# ...whether they were added before or after the hashed file
+agent.ingest_document_text("P", "Legacy text stored without a hash.")
+text_y = "Text Y about dogs."
+client.post("/upload", files={"file": ("y.txt", text_y, "text/plain")}, data={"doc_id": "P"})
+res = client.post("/upload", files={"file": ("y.txt", text_y, "text/plain")}, data={"doc_id": "Q"})
+print("Upload after legacy ingest status", res.status_code, res.json())
+assert [c["text"] for c in agent.load_document_chunks("Q")] == [text_y]
+
+# A sole-content source is still copied
+res = client.post("/upload", files={"file": ("y.txt", text_y, "text/plain")}, data={"doc_id": "R"})
+print("Copy from sole-content doc status", res.status_code, res.json())
+assert res.json()["ingested"]["duplicate_of"] == "Q"
+
+# Another process recording the same bytes under doc_id mid-copy is a duplicate, not an error
+from sqlalchemy import text as sa_text
+_find = agent.find_document_by_hash
+def racing_find(content_hash, doc_id=None):
+    found = _find(content_hash, doc_id)
+    with agent.engine.begin() as conn:
+        conn.execute(sa_text("INSERT INTO documents (doc_id, content_hash, chunk_count) VALUES (:d, :h, 1)"),
+                     {"d": doc_id, "h": content_hash})
+    return found
+agent.find_document_by_hash = racing_find
+res = client.post("/upload", files={"file": ("y.txt", text_y, "text/plain")}, data={"doc_id": "S"})
+agent.find_document_by_hash = _find
+print("Copy racing another worker status", res.status_code, res.json())
+assert res.status_code == 200 and res.json()["ingested"]["duplicate_of"] == "S"
+assert agent.load_document_chunks("S") == []
+
+# Concurrent uploads of the same bytes to the same doc_id ingest once
+import threading
+import time
+_embed_texts = agent.embed_texts
+def slow_embed_texts(*args, **kwargs):
+    # widen the check-then-ingest window
+    time.sleep(0.2)
+    return _embed_texts(*args, **kwargs)
+agent.embed_texts = slow_embed_texts
+text_c = "File C uploaded twice at the same time."
+threads = [threading.Thread(target=client.post, args=("/upload",),
+                            kwargs={"files": {"file": ("c.txt", text_c, "text/plain")}, "data": {"doc_id": "race"}})
+           for _ in range(4)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+agent.embed_texts = _embed_texts
+print("Concurrent upload chunks", len(agent.load_document_chunks("race")))
+assert len(agent.load_document_chunks("race")) == 1
+
 # Test PDF upload (mock - since we can't create real PDF in test)
 # In real usage, you'd upload an actual PDF file
 print("Note: PDF/Word upload supported - test with real files")
@@ -76,3 +172,32 @@ print("Note: PDF/Word upload supported - test with real files")
 # Ask a question
 res2 = client.post("/ask", json={"doc_id": "apidoc", "question": "What is RAG?"})
 print("Ask status", res2.status_code, res2.json())
+assert "answer" in res2.json()
+
+# Ask a batch of questions; answers stream back as NDJSON
+res3 = client.post("/ask/batch", json={"doc_id": "apidoc", "questions": ["What is RAG?", "What does RAG combine?"]})
+lines = [json.loads(l) for l in res3.text.splitlines() if l]
+print("Batch ask status", res3.status_code, lines)
+assert res3.status_code == 200
+assert sorted(l["index"] for l in lines) == [0, 1]
+assert all("answer" in l for l in lines)
+
+# Retrieval failures surface as a 500 before streaming starts
+def failing_embed_texts(*args, **kwargs):
+    raise RuntimeError("embedding backend down")
+agent.embed_texts = failing_embed_texts
+res5 = client.post("/ask/batch", json={"doc_id": "apidoc", "questions": ["What is RAG?"]})
+agent.embed_texts = _embed_texts
+print("Batch ask with failing retrieval status", res5.status_code, res5.json())
+assert res5.status_code == 500
+
+# Speculative pre-retrieval and per-mode statistics
+res4 = client.post("/ask", json={"doc_id": "apidoc", "question": "What is RAG?", "speculative": True})
+print("Speculative ask status", res4.status_code, res4.json())
+assert "answer" in res4.json()
+stats = client.get("/stats").json()
+print("Stats", stats)
+assert stats["agent"]["speculative"]["runs"] == 1
+assert stats["agent"]["speculative"]["llm_rounds"] == 1
+assert stats["agent"]["speculative"]["rounds_saved"] == 1
+assert stats["agent"]["speculative"]["standard_avg_rounds"] == 2
@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Ensure DB env is set before importing agent (db.py reads it at import time)
+os.environ.setdefault("RAG_DATABASE_URL", "sqlite:///./test_scheduler.db")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from openai import OpenAI
+
+import agent
+import scheduler
+
+
+# --- local fake OpenAI server that injects 429s and latency ---------------
+
+class FakeState:
+    lock = threading.Lock()
+    calls = {"/v1/embeddings": 0, "/v1/chat/completions": 0}
+    rejected = 0
+    # every Nth request is rejected with 429
+    reject_every = 3
+    latency = 0.02
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(FakeState.latency)
+        with FakeState.lock:
+            FakeState.calls[self.path] += 1
+            n = FakeState.calls[self.path]
+            reject = n % FakeState.reject_every == 1
+            if reject:
+                FakeState.rejected += 1
+        if reject:
+            self._send(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                       {"retry-after-ms": "20", "x-ratelimit-remaining-requests": "0"})
+            return
+
+        headers = {"x-ratelimit-limit-requests": "100", "x-ratelimit-remaining-requests": "90",
+                   "x-ratelimit-remaining-tokens": "100000"}
+        if self.path == "/v1/embeddings":
+            inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            data = [{"object": "embedding", "index": i, "embedding": [float(len(s) % 10)] * 8}
+                    for i, s in enumerate(inputs)]
+            self._send(200, {"object": "list", "data": data, "model": body["model"],
+                             "usage": {"prompt_tokens": 1, "total_tokens": 1}}, headers)
+            return
+
+        messages = body["messages"]
+        tool_msg = next((m for m in messages if m.get("role") == "tool"), None)
+        if tool_msg is None:
+            message = {"role": "assistant", "content": None, "tool_calls": [{
+                "id": "call_1", "type": "function",
+                "function": {"name": "search_document",
+                             "arguments": json.dumps({"query": messages[-1]["content"], "doc_id": "sched", "top_k": 2})},
+            }]}
+        else:
+            summary = " ".join(r["text"] for r in json.loads(tool_msg["content"]))
+            message = {"role": "assistant", "content": f"Answer (grounded): {summary}"}
+        self._send(200, {"id": "chatcmpl-1", "object": "chat.completion", "created": 0, "model": body["model"],
+                         "choices": [{"index": 0, "finish_reason": "stop", "message": message}]}, headers)
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAIHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+agent.client = OpenAI(api_key="test", base_url=f"http://127.0.0.1:{server.server_port}/v1", max_retries=0)
+agent.scheduler.base_delay = 0.01
+agent.EMBEDDING_BATCH_SIZE = 2
+
+text = "\n\n".join(f"Paragraph {i} about retrieval-augmented generation." for i in range(10))
+
+print("Ingesting through the fake server (429s injected)...")
+res = agent.ingest_document_text("sched", text)
+print("Ingest result:", res)
+assert res["chunks_added"] == 10
+
+print("Running agent_executor through the fake server...")
+out = agent.agent_executor("What is RAG?", doc_id="sched")
+print("Agent output:", out)
+assert "answer" in out
+
+stats = agent.scheduler.stats()
+print("Scheduler stats:", stats, "server rejected:", FakeState.rejected)
+assert FakeState.rejected > 0
+assert stats["rate_limited"] == FakeState.rejected
+assert stats["failures"] == 0
+
+
+# --- interactive work is admitted ahead of queued bulk work ---------------
+
+sched = scheduler.RequestScheduler(rpm=6000, tpm=10**6, max_concurrency=1)
+order = []
+gate = threading.Event()
+
+
+def job(name, hold=0.0):
+    def fn():
+        if hold:
+            gate.wait(2)
+        order.append(name)
+    return fn
+
+
+blocker = threading.Thread(target=sched.run, args=(job("blocker", hold=1),), kwargs={"priority": scheduler.BULK})
+blocker.start()
+time.sleep(0.05)
+
+threads = [threading.Thread(target=sched.run, args=(job(f"bulk{i}"),), kwargs={"priority": scheduler.BULK})
+           for i in range(3)]
+for t in threads:
+    t.start()
+time.sleep(0.05)
+interactive = threading.Thread(target=sched.run, args=(job("interactive"),), kwargs={"priority": scheduler.INTERACTIVE})
+interactive.start()
+time.sleep(0.05)
+
+gate.set()
+for t in [blocker, interactive] + threads:
+    t.join()
+
+print("Completion order:", order)
+assert order[:2] == ["blocker", "interactive"]
+
+
+# --- interactive work also goes first when the rate limit is the bottleneck
+
+sched = scheduler.RequestScheduler(rpm=6000, tpm=10**6, max_concurrency=8)
+# one request at a time, refilled at 20/s: callers queue on the bucket, not the gate
+sched.requests = scheduler.TokenBucket(1, 20)
+order = []
+
+threads = [threading.Thread(target=sched.run, args=(job(f"bulk{i}"),), kwargs={"priority": scheduler.BULK})
+           for i in range(6)]
+for t in threads:
+    t.start()
+time.sleep(0.01)
+interactive = threading.Thread(target=sched.run, args=(job("interactive"),), kwargs={"priority": scheduler.INTERACTIVE})
+interactive.start()
+for t in threads + [interactive]:
+    t.join()
+
+print("Completion order under rate limit:", order)
+# at most the bulk call already admitted and the one waiting on the bucket run first
+assert order.index("interactive") <= 2
+
+
+
+# --- malformed rate-limit headers don't discard a successful response -----
+
+class RawResponse:
+    headers = {"x-ratelimit-limit-requests": "unlimited", "x-ratelimit-remaining-requests": "5"}
+
+    def parse(self):
+        return "parsed"
+
+
+sched = scheduler.RequestScheduler(rpm=6000, tpm=10**6)
+assert sched.run(RawResponse) == "parsed"
+assert sched.stats()["failures"] == 0 and sched.stats()["retries"] == 0
+
+server.shutdown()
@@ -0,0 +1,79 @@
+import os
+import time
+import threading
+
+# Ensure DB env is set before importing agent (db.py reads it at import time)
+os.environ.setdefault("RAG_DATABASE_URL", "sqlite:///./test_singleflight.db")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import agent
+
+# Mock client that counts upstream embedding calls and is slow enough to overlap
+class MockEmb:
+    def __init__(self, emb):
+        self.embedding = emb
+
+class MockEmbResp:
+    def __init__(self, embs):
+        self.data = [MockEmb(e) for e in embs]
+
+class MockClient:
+    embedding_calls = 0
+    lock = threading.Lock()
+
+    class embeddings:
+        @staticmethod
+        def create(model, input):
+            with MockClient.lock:
+                MockClient.embedding_calls += 1
+            time.sleep(0.2)
+            inputs = [input] if isinstance(input, str) else input
+            return MockEmbResp([[float(len(s) % 10)] * 8 for s in inputs])
+
+agent.client = MockClient()
+
+# Count chunk fetches that actually hit the database
+db_fetches = 0
+_fetch = agent._fetch_document_chunks
+
+def counting_fetch(doc_id):
+    global db_fetches
+    db_fetches += 1
+    time.sleep(0.1)
+    return _fetch(doc_id)
+
+agent._fetch_document_chunks = counting_fetch
+
+text = """
+Single-flight coalescing shares one in-flight call between concurrent callers.
+
+Concurrent identical searches should embed the query once.
+"""
+agent.ingest_document_text("coalesce", text)
+MockClient.embedding_calls = 0
+
+N = 16
+barrier = threading.Barrier(N)
+results = []
+
+def worker():
+    barrier.wait()
+    results.append(agent.search_document("what is single-flight?", doc_id="coalesce", top_k=1))
+
+threads = [threading.Thread(target=worker) for _ in range(N)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+
+print("Concurrent searches:", N)
+print("Upstream embedding calls:", MockClient.embedding_calls)
+print("Database chunk fetches:", db_fetches)
+print("Embedding coalescing:", agent.embedding_flight.stats())
+print("Document coalescing:", agent.document_flight.stats())
+
+assert len(results) == N and all(r == results[0] for r in results)
+assert MockClient.embedding_calls == 1
+assert db_fetches == 1
+assert agent.embedding_flight.stats()["coalesced"] == N - MockClient.embedding_calls
+assert agent.document_flight.stats()["coalesced"] == N - db_fetches